@@ -1,4 +1,6 @@
 import torch
+import torch.nn as nn
+import torch.nn.functional as F
 
 class FrequencyEmbedder():
     """Embed input coordinates to network input vector."""
@@ -32,4 +34,45 @@ class FrequencyEmbedder():
         return len(self.embed_fns) * self.input_dims
 
     def __call__(self, inputs):
-        return torch.cat([fn(inputs) for fn in self.embed_fns], -1)
\ No newline at end of file
+        return torch.cat([fn(inputs) for fn in self.embed_fns], -1)
+
+
+class FusedEmbedding(nn.Module):
+    """
+    Multiple embedding tables indexed by the same ids, stored as a single weight matrix so that
+    all tables are looked up with one gather. The state dict keeps a separate "<name>.weight"
+    entry per table, compatible with a ModuleDict of nn.Embedding.
+    """
+    def __init__(self, weights: dict[str, torch.Tensor]):
+        """
+        Args:
+            weights: Initial weights of each table, {name: (num_embeddings, dim)}.
+        """
+        super().__init__()
+        self.names = list(weights.keys())
+        self.dims = [w.shape[1] for w in weights.values()]
+        self.weight = nn.Parameter(torch.cat(list(weights.values()), 1))
+
+    def forward(self, ids) -> dict[str, torch.Tensor]:
+        return dict(zip(self.names, F.embedding(ids, self.weight).split(self.dims, -1)))
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        weight = self.weight if keep_vars else self.weight.detach()
+        for name, w in zip(self.names, weight.split(self.dims, 1)):
+            destination[f"{prefix}{name}.weight"] = w.contiguous()
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys,
+                              unexpected_keys, error_msgs):
+        # fuse separate tables into one weight, keeping current values of missing tables
+        state_dict = dict(state_dict)
+        if prefix + 'weight' not in state_dict:
+            weights = list(self.weight.detach().split(self.dims, 1))
+            for idx, name in enumerate(self.names):
+                key = f"{prefix}{name}.weight"
+                if key in state_dict:
+                    weights[idx] = state_dict.pop(key)
+                else:
+                    missing_keys.append(key)
+            state_dict[prefix + 'weight'] = torch.cat(weights, 1)
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys,
+                                      unexpected_keys, error_msgs)
@@ -64,7 +64,10 @@ def add_train_arguments(p: configargparse.ArgParser) -> None:
     # Optimizer
     p.add('--optim_class', default='torch.optim.AdamW')
     p.add('--optim_class_input', default='torch.optim.Adam')
-    p.add('--optim_args', type=yaml.safe_load, default={})
+    p.add('--optim_args',
+          type=yaml.safe_load,
+          default={},
+          help="Optimizer arguments (Adam(W) defaults to fused=True on GPU unless fused/foreach set)")
     p.add('--optim_args_input', type=yaml.safe_load, default={})
     p.add('--optimize_latent', action='store_true', help="Optimize per-frame latent codes")
     p.add('--optimize_expression', action='store_true', help="Optimize expression inputs")
@@ -83,6 +86,19 @@ def add_train_arguments(p: configargparse.ArgParser) -> None:
     p.add('--lr_input', type=float, default=1e-3, help="Learning rate for inputs")
     p.add('--weight_decay', type=float, default=0, help="Weight decay for model params")
     p.add('--clip_grad_norm', type=float, help="Gradient clipping max norm")
+    p.add('--gradient_accumulation_steps',
+          type=int,
+          default=1,
+          help="Num iterations to accumulate gradients before each optimizer step. Iteration "
+          "counts (iterations, log/show/save/eval intervals, loss decay) stay in micro-batches, "
+          "while scheduler milestones count optimizer steps, i.e. iterations / this value")
+    p.add('--mixed_precision',
+          default='no',
+          choices=['no', 'fp16', 'bf16'],
+          help="Run model forward in mixed precision (fp16 requires no optimized inputs)")
+    p.add('--torch_compile_mode',
+          choices=['default', 'reduce-overhead', 'max-autotune'],
+          help="Compile model with torch.compile in the given mode (default as eager)")
 
     # Logging
     p.add('--log_it', type=int, default=20, help="Num iterations to log")
@@ -9,7 +9,7 @@ from accelerate import Accelerator
 from torch.utils.data import DataLoader
 from torchvision.utils import save_image
 
-from utils.training_util import seed_everything
+from utils.training_util import seed_everything, load_model_state
 from utils.misc_util import ensure_dir, find_latest_model_path, construct_class_by_name, Logger
 from utils.image_util import load_rgb_image
 from scripts.visualization import visualize_outputs
@@ -275,7 +275,7 @@ def testing_loop(
         else:
             checkpoints_dir = find_latest_model_path(checkpoints_dir)
         assert os.path.exists(checkpoints_dir), "No checkpoints found!"
-        model_state = torch.load(os.path.join(checkpoints_dir, "model.pth"), accel.device)
+        model_state = load_model_state(checkpoints_dir, accel.device)
         model.load_state_dict(model_state['model'], strict=True)
         it, sample_count = model_state['it'], model_state['sample_count']
         accel.print(
@@ -5,7 +5,7 @@ import os
 from imageio import imwrite
 from accelerate import Accelerator
 
-from utils.training_util import seed_everything
+from utils.training_util import seed_everything, load_model_state
 from utils.misc_util import ensure_dir, find_latest_model_path, construct_class_by_name, Logger
 
 
@@ -82,7 +82,7 @@ def texture_export(
         load_ckpt_dir = os.path.join(checkpoints_dir, f"iter_{export_iteration}")
     else:
         load_ckpt_dir = find_latest_model_path(checkpoints_dir)
-    model_state = torch.load(os.path.join(load_ckpt_dir, "model.pth"), accel.device)
+    model_state = load_model_state(load_ckpt_dir, accel.device)
     model.load_state_dict(model_state['model'], strict=True)
     it, sample_count = model_state['it'], model_state['sample_count']
     accel.print(f'Loaded checkpoint (iter {it}, samples {sample_count}) from: {load_ckpt_dir}')
@@ -1,16 +1,21 @@
 import torch
 import torch.nn as nn
-import numpy as np
 import time
 import tqdm
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from accelerate import Accelerator, DistributedDataParallelKwargs
+from accelerate.utils import send_to_device, gather_object
 from torch.utils.tensorboard import SummaryWriter
 from torch.utils.data import DataLoader
-from collections import deque
+from torchvision.utils import save_image
 
-from utils.training_util import InfiniteSampler, seed_everything, print_module_summary, log_value_dict, add_dict_to
+from utils.training_util import (InfiniteSampler, CUDAStreamPrefetcher, collate_dict_pairs,
+                                 seed_everything, print_module_summary, log_value_dict, add_dict_to,
+                                 copy_to_cpu, save_model_state, load_model_state)
 from utils.misc_util import ensure_dir, find_latest_model_path, construct_class_by_name, Logger
+from model.embedder import FusedEmbedding
 from scripts.visualization import visualize_outputs
 
 
@@ -62,6 +67,9 @@ def training_loop(
     lr_input,
     weight_decay,
     clip_grad_norm,
+    gradient_accumulation_steps,
+    mixed_precision,
+    torch_compile_mode,
     # Logging
     log_it,
     show_it,
@@ -73,9 +81,14 @@ def training_loop(
 ):
     accel = Accelerator(
         cpu=use_cpu,
+        mixed_precision=mixed_precision,
+        gradient_accumulation_steps=gradient_accumulation_steps,
         kwargs_handlers=[DistributedDataParallelKwargs(find_unused_parameters=False)],
     )
     seed_everything(seed + accel.process_index)  # set seed
+    if not use_cpu:  # allow TF32 tensor cores for fp32 matmul and convolution on Ampere+
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
     if accel.is_local_main_process:
         output_dir = os.path.join(rundir, "train_output")
         checkpoints_dir = os.path.join(rundir, "checkpoints")
@@ -84,6 +97,10 @@ def training_loop(
         ensure_dir(output_dir)
         ensure_dir(checkpoints_dir)
     accel.wait_for_everyone()
+    if gradient_accumulation_steps > 1:
+        accel.print(f"Accumulating gradients over {gradient_accumulation_steps} iterations: "
+                    f"{iterations} iterations run {iterations // gradient_accumulation_steps} "
+                    f"optimizer and scheduler steps, scale scheduler milestones accordingly.")
 
     # build train and validation dataset
     train_dataset = construct_class_by_name(class_name=dataset_class,
@@ -112,6 +129,7 @@ def training_loop(
                                                       accel.num_processes, not no_shuffle, seed),
                               drop_last=False,
                               num_workers=num_workers,
+                              collate_fn=collate_dict_pairs,
                               persistent_workers=True,
                               pin_memory=True)
     assert len(val_dataset) % accel.num_processes == 0, \
@@ -120,7 +138,11 @@ def training_loop(
                             batch_size=1,
                             shuffle=False,
                             drop_last=True,
-                            num_workers=num_workers)
+                            num_workers=num_workers,
+                            collate_fn=collate_dict_pairs,
+                            persistent_workers=num_workers > 0,
+                            prefetch_factor=2 if num_workers > 0 else None,
+                            pin_memory=True)
 
     # build model and loss
     model = construct_class_by_name(class_name=model_class,
@@ -131,47 +153,55 @@ def training_loop(
 
     # build (optional) optimizable input parameters
     optimize_inputs = optimize_latent or optimize_expression or optimize_pose or optimize_camera
+    # both prepared optimizers would share one GradScaler, which steps and updates it twice
+    assert not (optimize_inputs and mixed_precision == 'fp16'), \
+        "fp16 mixed precision is not supported when optimizing inputs, use bf16 instead"
     if optimize_inputs:
-        input_params = nn.ModuleDict()
         num_training_frames = len(train_dataset)
+        input_weights = {}
         if optimize_latent:
-            frame_latent = nn.Embedding(num_training_frames, model_args["dim_frame_latent"])
-            nn.init.uniform_(frame_latent.weight, 0, 1)
-            input_params.add_module("frame_latent", frame_latent)
+            input_weights["frame_latent"] = nn.init.uniform_(
+                torch.empty(num_training_frames, model_args["dim_frame_latent"]), 0, 1)
         if optimize_expression:
             init_exp = train_dataset.get_expression_params()  # tracked expression [N, 50]
-            init_exp = torch.cat(
+            input_weights["expression"] = torch.cat(
                 [init_exp,
                  torch.zeros(init_exp.shape[0], model_args["dim_expression"] - 50)], 1)
-            expression = nn.Embedding(num_training_frames,
-                                      model_args["dim_expression"],
-                                      _weight=init_exp)
-            input_params.add_module("expression", expression)
         if optimize_pose:
             init_pose = train_dataset.get_pose_params()  # tracked pose [N, 15]
-            pose = nn.Embedding(num_training_frames, 15, _weight=init_pose)
-            input_params.add_module("pose", pose)
+            input_weights["pose"] = init_pose
         if optimize_camera:
             init_extrinsic = train_dataset.get_extrinsic_params()  # tracked extrinsic [N, 4, 4]
-            cam_trans = nn.Embedding(num_training_frames, 3, _weight=init_extrinsic[:, :3, 3])
-            input_params.add_module("cam_trans", cam_trans)
+            input_weights["cam_trans"] = init_extrinsic[:, :3, 3]
+        # all input tables share frame ids, look them up with a single gather
+        input_params = FusedEmbedding(input_weights)
 
-    # build optimizer and scheduler
+    def with_fused_optim_args(optim_class, optim_args):
+        """use fused cuda kernels for Adam(W) if no implementation is specified"""
+        if accel.device.type == 'cuda' and optim_class in ('torch.optim.Adam', 'torch.optim.AdamW') \
+                and 'fused' not in optim_args and 'foreach' not in optim_args:
+            return optim_args | {'fused': True}
+        return optim_args
+
+    # build optimizer and scheduler (fused optimizers require parameters on device)
+    model.to(accel.device)
     optimizer = construct_class_by_name(model.parameters(),
                                         class_name=optim_class,
                                         lr=lr,
                                         weight_decay=weight_decay,
-                                        **optim_args)
+                                        **with_fused_optim_args(optim_class, optim_args))
     scheduler = construct_class_by_name(optimizer, class_name=scheduler_class, **scheduler_args)
     total_num = sum(p.numel() for p in model.parameters())
     trainable_num = sum(p.numel() for p in model.parameters() if p.requires_grad)
     accel.print(f"Model parameters total: {total_num}, trainable: {trainable_num}")
 
     if optimize_inputs:
+        input_params.to(accel.device)
         optimizer_input = construct_class_by_name(input_params.parameters(),
                                                   class_name=optim_class_input,
                                                   lr=lr_input,
-                                                  **optim_args_input)
+                                                  **with_fused_optim_args(
+                                                      optim_class_input, optim_args_input))
         scheduler_input = construct_class_by_name(optimizer_input,
                                                   class_name=scheduler_class_input,
                                                   **scheduler_args_input)
@@ -185,7 +215,7 @@ def training_loop(
     else:
         last_ckpt_dir = load_from or find_latest_model_path(checkpoints_dir)
     if last_ckpt_dir:
-        model_state = torch.load(os.path.join(last_ckpt_dir, "model.pth"), accel.device)
+        model_state = load_model_state(last_ckpt_dir, accel.device)
         missing_keys, unexpected_keys = model.load_state_dict(model_state['model'], strict=False)
         if len(unexpected_keys) > 0:
             accel.print(f"unexpected keys in model_state: {', '.join(unexpected_keys)}")
@@ -220,95 +250,133 @@ def training_loop(
     else:
         it, sample_count = 0, 0
 
-    # accelerate model training
+    # accelerate model training (train batches are moved to GPU by the stream prefetcher)
+    use_stream_prefetch = accel.device.type == 'cuda'
     model, train_loader, val_loader, optimizer, scheduler = \
-        accel.prepare(model, train_loader, val_loader, optimizer, scheduler)
+        accel.prepare(model, train_loader, val_loader, optimizer, scheduler,
+                      device_placement=[None, not use_stream_prefetch, None, None, None])
+    if use_stream_prefetch:
+        train_loader = CUDAStreamPrefetcher(train_loader, accel.device)
     if optimize_inputs:
         input_params, optimizer_input, scheduler_input = \
             accel.prepare(input_params, optimizer_input, scheduler_input)
+    accumulate_modules = (model, input_params) if optimize_inputs else (model, )
+
+    # compile model forward with TorchInductor (loss has data-dependent control flow, keep eager)
+    if torch_compile_mode is not None:
+        assert num_rays > 0, "torch.compile requires a fixed number of rays per sample"
+        compiled_model = torch.compile(model, mode=torch_compile_mode, dynamic=False)
+    else:
+        compiled_model = model
 
     def replace_optimizable_inputs(inputs, targets, fixed_id=None):
         """replace model inputs from optimizable parameters if needed"""
         ids = torch.full_like(inputs['id'], fixed_id) if fixed_id else inputs['id']
+        params = input_params(ids)
         if optimize_latent:
-            inputs['frame_latent'] = input_params['frame_latent'](ids)
+            inputs['frame_latent'] = params['frame_latent']
         if optimize_expression:
             targets['expression'] = inputs['expression']
-            inputs['expression'] = input_params['expression'](ids)
+            inputs['expression'] = params['expression']
         if optimize_pose:
             targets['pose'] = inputs['pose']
-            inputs['pose'] = input_params['pose'](ids)
+            inputs['pose'] = params['pose']
         if optimize_camera:
-            targets['extrinsic'] = inputs['extrinsic']
-            inputs['extrinsic'][:, :3, 3] = input_params['cam_trans'](ids)
+            targets['extrinsic'] = extrinsic = inputs['extrinsic']
+            # build a new tensor instead of writing the translation in place
+            inputs['extrinsic'] = torch.cat([
+                torch.cat([extrinsic[:, :3, :3], params['cam_trans'][:, :, None]], 2),
+                extrinsic[:, 3:],
+            ], 1)
 
     # print module summary
     if accel.is_main_process:
-        temp_dataset = construct_class_by_name(class_name=dataset_class,
-                                               data_dir=data_dir,
-                                               sub_dirs=train_subdirs,
-                                               img_res=img_res,
-                                               num_rays=128,
-                                               subsample=train_subsample,
-                                               use_semantics=loss_args["use_semantic"],
-                                               background_rgb=None,
-                                               no_gt=False,
-                                               **dataset_args)
-        temp_loader = DataLoader(temp_dataset,
-                                 1,
-                                 shuffle=True,
-                                 drop_last=False,
-                                 num_workers=1,
-                                 persistent_workers=False,
-                                 pin_memory=False)
-        temp_loader = accel.prepare(temp_loader)
-        inputs, targets = next(iter(temp_loader))
+        inputs, targets = send_to_device(collate_dict_pairs([train_dataset[0]]), accel.device)
         if optimize_inputs:
             replace_optimizable_inputs(inputs, targets)
         with open(os.path.join(rundir, 'model_summary.txt'), 'w') as f:
             print_module_summary(model, (inputs, ), out=f)
-        del temp_dataset, temp_loader
+
+    def save_checkpoint_files(ckpt_dir, ckpt_states):
+        """write snapshotted cpu states to files in the checkpoint directory"""
+        for filename, state in ckpt_states.items():
+            if filename.endswith(".safetensors"):
+                save_model_state(os.path.join(ckpt_dir, filename), state)
+            else:
+                torch.save(state, os.path.join(ckpt_dir, filename))
+        accel.print(f'Saved checkpoint to: {ckpt_dir}')
+
+    def save_image_in_background(image, filename):
+        """encode and write a visualization image on the background pool"""
+        if len(vis_futures) >= 8:  # bound the number of images held in memory
+            vis_futures.popleft().result()
+        vis_futures.append(vis_pool.submit(save_image, image, filename))
 
     # start training
     accel.print(f'Start training from iteration {it}, ksample {sample_count / 1000: .3f}')
     last_it, last_time = it, time.time()
-    avg_loss_dict = {}
+    loss_keys, loss_buf, ring_idx = [], torch.empty(avg_loss_it, 0, device=accel.device), 0
+    loss_present = torch.empty(avg_loss_it, 0, device=accel.device)  # 1 where a loss was seen
+    zero_loss = torch.zeros((), device=accel.device)  # placeholder for absent losses
+    save_pool, save_future = ThreadPoolExecutor(max_workers=1), None
+    vis_pool, vis_futures = ThreadPoolExecutor(max_workers=2), deque()
     model.train()
     if optimize_inputs:
         input_params.train()
 
     # infinite training loop
+    train_len = len(train_dataset)
     for inputs, targets in train_loader:
-        epoch = sample_count / len(train_dataset)
+        epoch = sample_count / train_len
 
-        # model forward
-        optimizer.zero_grad()
-        if optimize_inputs:
-            optimizer_input.zero_grad()
-            replace_optimizable_inputs(inputs, targets)
-        outputs = model(inputs)
-        loss_total, loss_dict = loss(outputs, targets, it)
+        # accumulate gradients, skipping gradient sync and optimizer steps between updates
+        with accel.accumulate(*accumulate_modules):
+            # model forward
+            if optimize_inputs:
+                replace_optimizable_inputs(inputs, targets)
+            outputs = compiled_model(inputs)
+            loss_total, loss_dict = loss(outputs, targets, it)
 
-        # update model parameters
-        accel.backward(loss_total)
-        if clip_grad_norm is not None:
-            accel.clip_grad_norm_(model.parameters(), max_norm=clip_grad_norm)
+            # update model parameters
+            accel.backward(loss_total)
+            if clip_grad_norm is not None and accel.sync_gradients:
+                # unscale fp16 gradients before clipping, only the model optimizer can use a
+                # grad scaler since fp16 is rejected when optimizing inputs
+                accel.unscale_gradients(optimizer=optimizer)
+                nn.utils.clip_grad_norm_(model.parameters(), clip_grad_norm, foreach=True)
+                if optimize_inputs:
+                    nn.utils.clip_grad_norm_(input_params.parameters(), clip_grad_norm, foreach=True)
+            optimizer.step()
+            scheduler.step()
+            optimizer.zero_grad(set_to_none=True)
             if optimize_inputs:
-                accel.clip_grad_norm_(input_params.parameters(), max_norm=clip_grad_norm)
-        optimizer.step()
-        scheduler.step()
-        if optimize_inputs:
-            optimizer_input.step()
-            scheduler_input.step()
-
-        # update running average loss
-        loss_dict = accel.gather(loss_dict)
-        for key, value in loss_dict.items():
-            if not key in avg_loss_dict:
-                avg_loss_dict[key] = deque(maxlen=avg_loss_it)
-            avg_loss_dict[key].append(value.item())
-        for key, value in avg_loss_dict.items():
-            loss_dict[key] = np.mean(avg_loss_dict[key])
+                optimizer_input.step()
+                scheduler_input.step()
+                optimizer_input.zero_grad(set_to_none=True)
+
+        # update running average loss in a [avg_loss_it, num_keys] ring buffer on device, with
+        # absent losses stored as 0 and tracked in a presence buffer so real NaNs still show up
+        new_keys = [k for k in loss_dict if k not in loss_keys]
+        if new_keys:
+            loss_keys += new_keys
+            loss_buf = torch.cat([loss_buf, loss_buf.new_zeros(avg_loss_it, len(new_keys))], 1)
+            loss_present = torch.cat(
+                [loss_present, loss_present.new_zeros(avg_loss_it, len(new_keys))], 1)
+        loss_buf[ring_idx] = torch.stack([loss_dict.get(k, zero_loss) for k in loss_keys])
+        loss_present[ring_idx] = torch.tensor([float(k in loss_dict) for k in loss_keys])
+        ring_idx = (ring_idx + 1) % avg_loss_it
+        if it % log_it == 0 or it % show_it == 0:
+            # gather window sums and counts from all processes only when they are read, aligning
+            # columns by sorted key since processes may have seen different losses
+            avg_keys = sorted(set().union(*gather_object([loss_keys])))
+            local_sums = dict(zip(loss_keys, loss_buf.sum(0)))
+            local_counts = dict(zip(loss_keys, loss_present.sum(0)))
+            sums_counts = torch.stack([
+                torch.stack([local_sums.get(k, zero_loss) for k in avg_keys]),
+                torch.stack([local_counts.get(k, zero_loss) for k in avg_keys]),
+            ])
+            loss_sums, loss_counts = accel.gather(sums_counts[None]).sum(0).tolist()
+            loss_dict = {k: s / c for k, s, c in zip(avg_keys, loss_sums, loss_counts) if c > 0}
 
         # logging
         if it % log_it == 0 and accel.is_local_main_process:
@@ -342,25 +410,29 @@ def training_loop(
         if it % save_it == 0 and accel.is_local_main_process:
             ckpt_dir = os.path.join(checkpoints_dir, f'iter_{it}')
             ensure_dir(ckpt_dir)
-            torch.save(
-                {
+            ckpt_states = {
+                "model.safetensors": {
                     'it': it,
                     'sample_count': sample_count,
                     'epoch': epoch,
                     'model': accel.get_state_dict(model),
-                }, os.path.join(ckpt_dir, "model.pth"))
-            torch.save({
-                'optimizer': optimizer.state_dict(),
-                'scheduler': scheduler.state_dict(),
-            }, os.path.join(ckpt_dir, "optimizer.pth"))
+                },
+                "optimizer.pth": {
+                    'optimizer': optimizer.state_dict(),
+                    'scheduler': scheduler.state_dict(),
+                },
+            }
             if optimize_inputs:
-                torch.save(input_params.state_dict(), os.path.join(ckpt_dir, "input.pth"))
-                torch.save(
-                    {
-                        'optimizer': optimizer_input.state_dict(),
-                        'scheduler': scheduler_input.state_dict(),
-                    }, os.path.join(ckpt_dir, "optimizer_input.pth"))
-            accel.print(f'Saved checkpoint at {it} iter to: {ckpt_dir}')
+                ckpt_states["input.pth"] = input_params.state_dict()
+                ckpt_states["optimizer_input.pth"] = {
+                    'optimizer': optimizer_input.state_dict(),
+                    'scheduler': scheduler_input.state_dict(),
+                }
+            # snapshot states to cpu synchronously, then write them to disk in background
+            if save_future is not None:
+                save_future.result()  # wait for the previous checkpoint and raise its errors
+            save_future = save_pool.submit(save_checkpoint_files, ckpt_dir, copy_to_cpu(ckpt_states))
+            accel.print(f'Saving checkpoint at {it} iter to: {ckpt_dir}')
 
         # evaluate model with validation dataset and save results
         if it % eval_it == 0 and len(val_dataset) > 0:
@@ -369,29 +441,38 @@ def training_loop(
             if optimize_inputs:
                 input_params.eval()
 
-            val_loss_dict = {}
-            val_num_batches = torch.tensor([0], dtype=torch.long)
+            val_loss_dict, val_num_batches = {}, 0
             for val_inputs, val_targets in tqdm.tqdm(val_loader,
                                                      desc='eval progress',
                                                      disable=not accel.is_local_main_process):
                 with torch.no_grad():
-                    val_outputs = model(val_inputs)
+                    val_outputs = compiled_model(val_inputs)
                     _, loss_dict = loss(val_outputs, val_targets, it)
                 add_dict_to(val_loss_dict, loss_dict)
-                val_num_batches.add_(1)
+                val_num_batches += 1
 
-                # save visualization result
-                visualize_outputs(output_dir, val_inputs, val_outputs, val_targets, it, **vis_args)
+                # save visualization result, encoding and writing images in background
+                visualize_outputs(output_dir,
+                                  val_inputs,
+                                  val_outputs,
+                                  val_targets,
+                                  it,
+                                  save_fn=save_image_in_background,
+                                  **vis_args)
+            while vis_futures:
+                vis_futures.popleft().result()
 
-            # gather loss dicts from all processes
-            val_loss_dict['num_batches'] = val_num_batches.to(accel.device)
-            val_loss_dict = accel.gather(val_loss_dict)
+            # sum losses and batch counts over all processes with a single reduce, aligning keys
+            # across processes and filling losses a process never saw with 0
+            val_keys = sorted(set().union(*gather_object([list(val_loss_dict)])))
+            val_sums = torch.stack([val_loss_dict.get(k, zero_loss).float() for k in val_keys] +
+                                   [torch.tensor(float(val_num_batches), device=accel.device)])
+            val_sums = accel.reduce(val_sums, reduction='sum').tolist()
 
             if accel.is_local_main_process:
                 # average validation losses
-                val_num_batches = torch.sum(val_loss_dict.pop('num_batches')).item()
-                for k in val_loss_dict:
-                    val_loss_dict[k] = torch.sum(val_loss_dict[k]).item() / val_num_batches
+                val_num_batches = int(val_sums.pop())
+                val_loss_dict = {k: v / val_num_batches for k, v in zip(val_keys, val_sums)}
 
                 # log validation results
                 eval_elapsed = time.time() - eval_start_time
@@ -414,3 +495,9 @@ def training_loop(
         sample_count += batch_size * accel.num_processes
         if it > iterations:
             break
+
+    # wait for pending checkpoint writes
+    if save_future is not None:
+        save_future.result()
+    save_pool.shutdown()
+    vis_pool.shutdown()
@@ -14,7 +14,8 @@ def visualize_outputs(output_dir,
                       targets,
                       iter=None,
                       near_depth=None,
-                      far_depth=None):
+                      far_depth=None,
+                      save_fn=None):
     for batch_idx in range(inputs['img_res'].shape[0]):
         if iter is not None:
             dir = os.path.join(output_dir, inputs['sub_dir'][batch_idx], f"iter_{iter}")
@@ -75,7 +76,8 @@ def visualize_outputs(output_dir,
                              lbs_weights_output,
                              shapedirs_output,
                              filename=make_filename("result"),
-                             nrow=4)
+                             nrow=4,
+                             save_fn=save_fn)
         else:
             visualize_images(img_res,
                              rgb_target,
@@ -85,7 +87,8 @@ def visualize_outputs(output_dir,
                              normal_output,
                              depth_output,
                              filename=make_filename("result"),
-                             nrow=4)
+                             nrow=4,
+                             save_fn=save_fn)
 
         alpha = outputs['alpha_manifold'][batch_idx].swapaxes(0, 1).unsqueeze(-1)
         mask = outputs['mask_manifold'][batch_idx].swapaxes(0, 1).unsqueeze(-1).float()
@@ -113,7 +116,8 @@ def visualize_outputs(output_dir,
                              visualize_texture_coef(outputs, batch_idx).swapaxes(0, 1),
                              lbs_weights.swapaxes(0, 1),
                              shapedirs.swapaxes(0, 1),
-                             filename=make_filename("manifold"))
+                             filename=make_filename("manifold"),
+                             save_fn=save_fn)
         else:
             visualize_images(img_res,
                              feat_rgb,
@@ -122,7 +126,8 @@ def visualize_outputs(output_dir,
                              normal,
                              alpha,
                              visualize_texture_coef(outputs, batch_idx).swapaxes(0, 1),
-                             filename=make_filename("manifold"))
+                             filename=make_filename("manifold"),
+                             save_fn=save_fn)
 
 
 def visualize_flame_weights(outputs, batch_idx):
@@ -123,7 +123,8 @@ def visualize_images(img_res,
                      value_range=None,
                      padding=1,
                      pad_value=0,
-                     nrow=None):
+                     nrow=None,
+                     save_fn=None):
     """
     Visualize a list of tensor images. Each column corresponds to one tensor in images.
     Args:
@@ -135,6 +136,7 @@ def visualize_images(img_res,
         padding: int. Amount of padding. Default: 1.
         pad_value: int. Value for the padded pixels. Default: 0.
         nrow: int. Max number of rows in the grid. Default: len(images).
+        save_fn: callable(grid_tensor, filename) used to save the image. Default: save_image.
     Returns:
         grid_tensor: tensor of shape (3, height, width).
     """
@@ -154,6 +156,6 @@ def visualize_images(img_res,
                                               pad_value=pad_value)
 
     if filename is not None:
-        torchvision.utils.save_image(grid_tensor, filename)
+        (save_fn or torchvision.utils.save_image)(grid_tensor, filename)
 
     return grid_tensor
@@ -1,4 +1,6 @@
 import sys
+import os
+import json
 import math
 import torch
 import random
@@ -6,6 +8,9 @@ import numpy as np
 import torch.nn.init as init
 from torch.utils.data.sampler import Sampler
 from torch.utils.data.dataset import Dataset
+from torch.utils.data._utils.collate import collate_tensor_fn
+import safetensors.torch
+from accelerate.utils import send_to_device, recursively_apply
 from .misc_util import EasyDict
 
 
@@ -26,6 +31,40 @@ def add_dict_to(total_dict, dict_to_add):
             total_dict[k] = v
 
 
+def copy_to_cpu(data):
+    """Recursively copy all tensors in data to cpu, detached from the original storage."""
+    return recursively_apply(lambda t: t.detach().to('cpu', copy=True), data)
+
+
+def save_model_state(path, state):
+    """
+    Save a model checkpoint to a safetensors file.
+    Args:
+        path: Path to the safetensors file.
+        state: Dict with the model state dict in 'model', other (json serializable) values
+            such as 'it' and 'sample_count' are stored in the file metadata.
+    """
+    tensors = {k: v.contiguous() for k, v in state['model'].items()}
+    metadata = {k: json.dumps(v) for k, v in state.items() if k != 'model'}
+    safetensors.torch.save_file(tensors, path, metadata)
+
+
+def load_model_state(ckpt_dir, device):
+    """
+    Load a model checkpoint from model.safetensors in the checkpoint directory, directly onto
+    the device. Falls back to the pickled model.pth of older checkpoints.
+    Returns: Dict with the model state dict in 'model' and the saved metadata values.
+    """
+    path = os.path.join(ckpt_dir, "model.safetensors")
+    if not os.path.exists(path):
+        return torch.load(os.path.join(ckpt_dir, "model.pth"), device)
+    with safetensors.safe_open(path, framework="pt") as f:
+        metadata = f.metadata() or {}
+    state = {k: json.loads(v) for k, v in metadata.items()}
+    state['model'] = safetensors.torch.load_file(path, device=str(device))
+    return state
+
+
 def log_value_dict(tb_logger, tag, value_dict, it):
     for name, value in value_dict.items():
         tb_logger.add_scalar(f'{tag}/{name}', value, it)
@@ -220,6 +259,55 @@ class InfiniteSampler(Sampler):
             pass
 
 
+def collate_dict_pairs(batch):
+    """
+    Collate a list of (inputs, targets) samples of flat dicts. Tensors are stacked key by key
+    (into shared memory inside workers) without the recursive type dispatch of default_collate,
+    other values such as strings are gathered into lists.
+    """
+    def collate_dicts(dicts):
+        return {
+            k: collate_tensor_fn([d[k] for d in dicts]) if isinstance(v, torch.Tensor) else
+            [d[k] for d in dicts]
+            for k, v in dicts[0].items()
+        }
+
+    inputs, targets = zip(*batch)
+    return collate_dicts(inputs), collate_dicts(targets)
+
+
+class CUDAStreamPrefetcher:
+    """
+    Wrap a data loader to copy the next batch to GPU on a side CUDA stream, so that the
+    host-to-device transfer of batch N+1 overlaps with the computation of batch N.
+    The wrapped loader should yield pinned CPU tensors (i.e. pin_memory=True).
+    """
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device)
+
+    def _preload(self, loader_iter):
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return send_to_device(batch, self.device, non_blocking=True)
+
+    def __iter__(self):
+        loader_iter = iter(self.loader)
+        next_batch = self._preload(loader_iter)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            batch = next_batch
+            # tensors allocated on the side stream are now used by the current stream
+            recursively_apply(lambda t: t.record_stream(current_stream), batch)
+            next_batch = self._preload(loader_iter)
+            yield batch
+
+
 def fake_quant(x: torch.Tensor, scale=128, zero_point=0, num_bits=8, signed=True):
     """Fake quantization while keep float gradient."""
     x_quant = (x.detach() * scale + zero_point).round().int()